@@ -2,21 +2,44 @@
 Embedding utilities:
 - uses OpenAI if available (via openai package)
 - otherwise falls back to sentence-transformers (if installed)
-- ensures final vector is a plain Python list of floats
+- returns vectors as float32 numpy arrays (the precision the APIs produce)
+- CachedEmbedder keeps computed vectors in a persistent on-disk cache
 """
 
+import functools
+import math
 import os
-from typing import Callable, List
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
 import numpy as np
+import blake3
 
 # Try OpenAI 'openai' package first
 USE_OPENAI = bool(os.getenv("USE_OPENAI", "1") == "1")
 OPENAI_API_KEY_PATH = os.getenv("OPENAI_KEY_FILE", "../../../../data/GenAI/openai_key.txt")
 OPENAI_EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")  # adjust as needed
+SBERT_MODEL = "all-MiniLM-L6-v2"
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./.embedcache")
+# Token budget for the embeddings endpoint (tokens per minute) and retry policy
+EMBED_TOKENS_PER_MIN = int(os.getenv("EMBED_TOKENS_PER_MIN", "250000"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+# Keep-alive connection pool shared by all OpenAI calls, and (connect, read) timeouts
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "64"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "128"))
+EMBED_REQUEST_TIMEOUT = (5.0, 60.0)
+# l2_normalize_rows switches to the numba kernel (when installed) from this many rows,
+# i.e. fetch_all_embeddings on large tables once RAG_BRUTE_FORCE_MAX_ROWS is raised
+NUMBA_NORMALIZE_MIN_ROWS = int(os.getenv("NUMBA_NORMALIZE_MIN_ROWS", "100000"))
 
 # Lazy imports
 _openai = None
 _sbert_model = None
+_budget_lock = threading.Lock()
+_budget_window_start = 0.0
+_budget_tokens_used = 0
 
 
 def _load_openai():
@@ -25,12 +48,26 @@ def _load_openai():
         try:
             import openai as _openai_pkg
             _openai_pkg.api_key = os.getenv("OPENAI_API_KEY") or _read_api_key_file()
+            _openai_pkg.requestssession = _http_session()
             _openai = _openai_pkg
         except Exception as e:
             _openai = None
     return _openai
 
 
+def _http_session():
+    """
+    requests session with a pool large enough for concurrent embedding batches,
+    so calls reuse kept-alive connections instead of paying a new TLS handshake.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                          pool_maxsize=HTTP_POOL_MAXSIZE))
+    return session
+
+
 def _read_api_key_file() -> str:
     try:
         with open(OPENAI_API_KEY_PATH, "r") as f:
@@ -39,41 +76,259 @@ def _read_api_key_file() -> str:
         return ""
 
 
-def embed_text_openai(text: str) -> List[float]:
+def embed_text_openai(text: str) -> np.ndarray:
     """
     Use OpenAI API (openai package) to create embeddings.
-    Returns a Python list of floats.
+    Returns a float32 numpy array.
     """
     client = _load_openai()
     if client is None:
         raise RuntimeError("OpenAI package not available or API key not set")
 
-    resp = client.Embedding.create(input=text, model=OPENAI_EMBED_MODEL)
+    resp = _create_embeddings(client, text)
     emb = resp["data"][0]["embedding"]
-    # ensure Python list, not numpy types
-    return [float(x) for x in emb]
+    return np.asarray(emb, dtype=np.float32)
 
 
-def embed_text_sbert(text: str) -> List[float]:
+def _create_embeddings(client, input):
     """
-    Fallback: create embeddings with sentence-transformers.
+    Embedding.create with retries: rate limits, timeouts, connection errors and 5xx
+    responses are retried with exponential backoff, up to EMBED_MAX_RETRIES attempts.
     """
+    retryable = (client.error.RateLimitError, client.error.Timeout,
+                 client.error.APIConnectionError, client.error.ServiceUnavailableError)
+    for attempt in range(EMBED_MAX_RETRIES):
+        try:
+            return client.Embedding.create(input=input, model=OPENAI_EMBED_MODEL,
+                                           request_timeout=EMBED_REQUEST_TIMEOUT)
+        except retryable:
+            if attempt == EMBED_MAX_RETRIES - 1:
+                raise
+            # jitter keeps concurrent workers from retrying in lockstep
+            time.sleep(2 ** attempt + random.random())
+
+
+def estimate_tokens(texts: List[str]) -> int:
+    """Rough token estimate (~4 characters per token) used for rate limiting."""
+    return sum(len(t) // 4 + 1 for t in texts)
+
+
+def _wait_for_token_budget(n_tokens: int) -> None:
+    """Sleep until n_tokens fit into the current one-minute token budget (thread-safe)."""
+    global _budget_window_start, _budget_tokens_used
+    with _budget_lock:
+        now = time.monotonic()
+        if now - _budget_window_start >= 60.0:
+            _budget_window_start, _budget_tokens_used = now, 0
+        if _budget_tokens_used and _budget_tokens_used + n_tokens > EMBED_TOKENS_PER_MIN:
+            time.sleep(max(0.0, 60.0 - (now - _budget_window_start)))
+            _budget_window_start, _budget_tokens_used = time.monotonic(), 0
+        _budget_tokens_used += n_tokens
+
+
+def embed_texts_openai(texts: List[str]) -> List[np.ndarray]:
+    """
+    Batched variant of embed_text_openai: one API call for many texts.
+    Returns one float32 numpy array per input text, in input order.
+    """
+    client = _load_openai()
+    if client is None:
+        raise RuntimeError("OpenAI package not available or API key not set")
+    if not texts:
+        return []
+
+    _wait_for_token_budget(estimate_tokens(texts))
+    resp = _create_embeddings(client, texts)
+
+    # the API tags each result with the position of its input
+    data = sorted(resp["data"], key=lambda d: d["index"])
+    return [np.asarray(d["embedding"], dtype=np.float32) for d in data]
+
+
+def _load_sbert():
     global _sbert_model
     if _sbert_model is None:
         try:
             from sentence_transformers import SentenceTransformer
-            _sbert_model = SentenceTransformer("all-MiniLM-L6-v2")
+            _sbert_model = SentenceTransformer(SBERT_MODEL)
         except Exception as e:
             raise RuntimeError("sentence-transformers not installed and OpenAI not available") from e
-    v = _sbert_model.encode([text])[0]
-    return [float(x) for x in v.tolist()]
+    return _sbert_model
+
+
+def embed_text_sbert(text: str) -> np.ndarray:
+    """
+    Fallback: create embeddings with sentence-transformers.
+    """
+    v = _load_sbert().encode([text])[0]
+    return np.asarray(v, dtype=np.float32)
 
 
-def get_embedder() -> Callable[[str], List[float]]:
+def embed_texts_sbert(texts: List[str]) -> List[np.ndarray]:
     """
-    Returns an embed_fn(text)->List[float], controlled by USE_OPENAI env var.
+    Batched variant of embed_text_sbert.
+    """
+    if not texts:
+        return []
+    vs = _load_sbert().encode(list(texts))
+    return [np.asarray(v, dtype=np.float32) for v in vs]
+
+
+@functools.lru_cache(maxsize=1)
+def _numba_normalizer() -> Optional[Callable[[np.ndarray], None]]:
+    """
+    Fused parallel normalization kernel, or None without numba. Imported on first use:
+    numba is optional and slow to import, and only very large matrices need it.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _normalize_inplace(M):
+        """One streaming pass per row: sum of squares, then scale, rows split across threads."""
+        N, D = M.shape
+        for i in numba.prange(N):
+            s = 0.0
+            for j in range(D):
+                s += M[i, j] * M[i, j]
+            inv = 1.0 / (math.sqrt(s) + 1e-12)
+            for j in range(D):
+                M[i, j] *= inv
+
+    return _normalize_inplace
+
+
+def l2_normalize_rows(M: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the rows of a float32 matrix in place (einsum sum-of-squares + one sqrt).
+    Large matrices go through the numba kernel when numba is installed.
+    """
+    if len(M) >= NUMBA_NORMALIZE_MIN_ROWS:
+        kernel = _numba_normalizer()
+        if kernel is not None:
+            kernel(M)
+            return M
+    sq = np.einsum("ij,ij->i", M, M)
+    M *= (1.0 / np.sqrt(sq + 1e-24, dtype=np.float32))[:, None]
+    return M
+
+
+def l2_normalize(v: np.ndarray) -> np.ndarray:
+    """Return a unit-length float32 copy of vector v."""
+    v = np.array(v, dtype=np.float32)
+    v *= np.float32(1.0 / np.sqrt(np.einsum("i,i->", v, v) + 1e-24))
+    return v
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedder() -> Callable[[str], np.ndarray]:
+    """
+    Returns an embed_fn(text)->np.ndarray, controlled by USE_OPENAI env var.
+    Memoized: every caller shares one embedder and, through _load_openai(), one
+    OpenAI module configured with the pooled keep-alive session.
     """
     if USE_OPENAI:
         return embed_text_openai
     else:
         return embed_text_sbert
+
+
+@functools.lru_cache(maxsize=1)
+def get_batch_embedder() -> Callable[[List[str]], List[np.ndarray]]:
+    """
+    Returns an embed_many(texts)->List[np.ndarray], controlled by USE_OPENAI env var.
+    Memoized like get_embedder().
+    """
+    if USE_OPENAI:
+        return embed_texts_openai
+    else:
+        return embed_texts_sbert
+
+
+def embedding_model_name() -> str:
+    """Name of the model behind get_embedder()/get_batch_embedder()."""
+    return OPENAI_EMBED_MODEL if USE_OPENAI else SBERT_MODEL
+
+
+# Output width of the models this module knows; others are probed once
+EMBED_DIMS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+    "all-MiniLM-L6-v2": 384,
+}
+
+
+@functools.lru_cache(maxsize=1)
+def embedding_dim() -> int:
+    """Vector width of get_embedder()'s model (one probe embedding for unknown models)."""
+    model = embedding_model_name()
+    if model in EMBED_DIMS:
+        return EMBED_DIMS[model]
+    return len(get_embedder()("dimension probe"))
+
+
+class CachedEmbedder:
+    """
+    Content-addressed embedding cache backed by sqlite in EMBED_CACHE_DIR.
+
+    Vectors are keyed by blake3(model + NUL + text), so an identical (text, model)
+    pair is only sent to the embedding API once across runs and table rebuilds.
+    Calling the instance embeds a batch with the default compute_batch/model.
+    Safe to share between threads; compute_batch runs outside the cache lock.
+    """
+
+    def __init__(self, compute_batch: Optional[Callable[[List[str]], List[np.ndarray]]] = None,
+                 model: Optional[str] = None, cache_dir: str = EMBED_CACHE_DIR):
+        self.compute_batch = compute_batch or get_batch_embedder()
+        self.model = model or embedding_model_name()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "embeddings.sqlite"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)")
+
+    @staticmethod
+    def cache_key(text: str, model: str) -> str:
+        return blake3.blake3(model.encode("utf-8") + b"\0" + text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self._conn.execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def put(self, key: str, vec) -> None:
+        blob = np.asarray(vec, dtype=np.float32).tobytes()
+        self._conn.execute("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", (key, blob))
+
+    def get_or_compute_many(self, texts: List[str], model: str,
+                            compute_batch: Callable[[List[str]], List[np.ndarray]]) -> List[np.ndarray]:
+        """
+        Return one float32 vector per text. Cache misses are embedded with a single
+        compute_batch(misses) call and written back to the cache.
+        """
+        keys = [self.cache_key(t, model) for t in texts]
+        with self._lock:
+            out: List[Optional[np.ndarray]] = [self.get(k) for k in keys]
+
+        # a text repeated within the batch is only computed once
+        misses = {}
+        for i, v in enumerate(out):
+            if v is None:
+                misses.setdefault(keys[i], []).append(i)
+        if misses:
+            miss_texts = [texts[idx[0]] for idx in misses.values()]
+            vecs = compute_batch(miss_texts)
+            if len(vecs) != len(miss_texts):
+                raise ValueError("compute_batch must return one embedding per text")
+            with self._lock:
+                for (key, idx), vec in zip(misses.items(), vecs):
+                    vec = np.asarray(vec, dtype=np.float32)
+                    self.put(key, vec)
+                    for i in idx:
+                        out[i] = vec
+                self._conn.commit()
+        return out
+
+    def __call__(self, texts: List[str]) -> List[np.ndarray]:
+        return self.get_or_compute_many(texts, self.model, self.compute_batch)
@@ -1,14 +1,23 @@
 """
 RAGEngine - given a RealEstateDBManager and an embed function, run retrieval and call chat LLM.
-Outputs JSON-serializable dicts (safe for json.dumps).
+Outputs plain dicts; use dumps_json() to serialize them (numpy values included).
 """
 
+import functools
+import math
+import operator
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
-import json
+import orjson
 import openai  # using standard openai package
-from real_estate_db import RealEstateDBManager
+
+try:  # optional: SIMD/multi-threaded exact inner-product search for the fallback path
+    import faiss
+except ImportError:
+    faiss = None
+from real_estate_db import RealEstateDBManager, SCAN_COLUMNS
+from embedding_utils import l2_normalize
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_KEY")
 if not OPENAI_API_KEY:
@@ -25,10 +34,33 @@ if OPENAI_API_KEY:
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
 TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.2"))
 MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "600"))
+# Brute-force fallback scores int8-quantized rows once the table has this many rows (0 = off).
+# The fallback only scans tables below BRUTE_FORCE_MAX_ROWS, so raise that one too.
+INT8_MIN_ROWS = int(os.getenv("RAG_INT8_MIN_ROWS", "0"))
+INT8_BLOCK_ROWS = 4096
+# Without a working native search, only tables smaller than this are scanned in memory
+BRUTE_FORCE_MAX_ROWS = int(os.getenv("RAG_BRUTE_FORCE_MAX_ROWS", "1000"))
+# Number of distinct query embeddings memoized per RAGEngine
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "1024"))
+# HNSW search beam width used by RAGEngine unless overridden per engine or per query
+EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "128"))
+# The index stores SQ8-quantized vectors; re-rank k * REFINE_FACTOR candidates on the stored vectors
+REFINE_FACTOR = int(os.getenv("RAG_REFINE_FACTOR", "4"))
+
+
+def dumps_json(obj: Any, indent: bool = False) -> bytes:
+    """Serialize a query result with orjson; numpy scalars/arrays are handled natively."""
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, option=option)
 
 
 def _to_json_safe(obj: Any) -> Any:
-    """Recursively convert numpy / pandas dtypes to Python native types."""
+    """
+    Recursively convert numpy / pandas dtypes to Python native types.
+    Deprecated: results are serialized with dumps_json(); kept for existing callers.
+    """
     if isinstance(obj, dict):
         return {k: _to_json_safe(v) for k, v in obj.items()}
     if isinstance(obj, list):
@@ -40,75 +72,206 @@ def _to_json_safe(obj: Any) -> Any:
     return obj
 
 
-def _cosine_similarity_matrix(emb_matrix: np.ndarray, q: np.ndarray) -> np.ndarray:
-    """Compute cosine similarity between rows of emb_matrix and q (both numpy arrays)."""
-    emb_norm = emb_matrix / (np.linalg.norm(emb_matrix, axis=1, keepdims=True) + 1e-12)
-    q_norm = q / (np.linalg.norm(q) + 1e-12)
-    sims = (emb_norm @ q_norm).astype(float)
-    return sims
+def _quantize_int8(emb_arr: np.ndarray):
+    """Symmetric per-row int8 quantization: returns (int8 rows, float32 per-row scale)."""
+    scale = np.abs(emb_arr).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.round(emb_arr / scale[:, None]).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def _int8_similarities(q_rows: np.ndarray, row_scale: np.ndarray, qv: np.ndarray) -> np.ndarray:
+    """Dot products of int8 rows with a quantized query, upcast block by block to avoid overflow."""
+    q_scale = float(np.abs(qv).max()) / 127.0 or 1.0
+    q_q = np.round(qv / q_scale).astype(np.int8).astype(np.float32)
+    dots = np.empty(len(q_rows), dtype=np.float32)
+    for start in range(0, len(q_rows), INT8_BLOCK_ROWS):
+        block = q_rows[start:start + INT8_BLOCK_ROWS]
+        dots[start:start + len(block)] = block.astype(np.float32) @ q_q
+    return dots * row_scale * np.float32(q_scale)
+
+
+_FILTER_OPS = {">=": operator.ge, "<=": operator.le, "=": operator.eq}
+# Columns a filter may name: the ones the fallback scan reads too, so a filter behaves the
+# same on both paths. Keys become SQL identifiers, so anything else is rejected. The price
+# display string is left out: filter on price_usd.
+FILTER_COLUMNS = [c for c in SCAN_COLUMNS if c not in ("embedding", "price")]
+# Numeric columns: the only ones that take min_/max_ bounds, and they take numbers only
+NUMERIC_FILTER_COLUMNS = ["price_usd", "bedrooms", "bathrooms"]
+
+
+def _parse_filters(filters: Optional[Dict[str, Any]]) -> List[Tuple[str, str, Any]]:
+    """
+    Turn {"min_bedrooms": 3, "max_bathrooms": 2, "neighborhood": "Oak Hill"} into
+    (column, op, value) triples: min_/max_ prefixes are bounds, other keys are equality.
+    Raises ValueError for columns outside FILTER_COLUMNS, bounds on text columns, and
+    values that are not a str (text columns) or a finite int/float (numeric columns).
+    """
+    triples = []
+    for key, value in (filters or {}).items():
+        if value is None:
+            continue
+        if key.startswith("min_"):
+            col, op = key[4:], ">="
+        elif key.startswith("max_"):
+            col, op = key[4:], "<="
+        else:
+            col, op = key, "="
+        if col not in FILTER_COLUMNS:
+            raise ValueError(f"unknown filter {key!r}; filterable columns: {', '.join(FILTER_COLUMNS)}")
+        if isinstance(value, np.generic):
+            value = value.item()  # np.int64(3) -> 3, so the SQL literal is plain "3"
+        if col in NUMERIC_FILTER_COLUMNS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"filter {key!r} needs a finite number, got {value!r}")
+        elif op != "=":
+            raise ValueError(f"filter {key!r}: min_/max_ bounds only apply to {', '.join(NUMERIC_FILTER_COLUMNS)}")
+        elif not isinstance(value, str):
+            raise ValueError(f"filter {key!r} needs a str, got {type(value).__name__}")
+        triples.append((col, op, value))
+    return triples
+
+
+def _where_clause(triples: List[Tuple[str, str, Any]]) -> Optional[str]:
+    """SQL predicate for LanceDB, e.g. "bedrooms >= 3 AND neighborhood = 'Oak Hill'"."""
+    parts = []
+    for col, op, value in triples:
+        lit = "'" + value.replace("'", "''") + "'" if isinstance(value, str) else repr(value)
+        parts.append(f"{col} {op} {lit}")
+    return " AND ".join(parts) or None
+
+
+def _filter_mask(df, triples: List[Tuple[str, str, Any]]) -> np.ndarray:
+    """Boolean row mask applying the same triples to an in-memory frame."""
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in triples:
+        mask &= _FILTER_OPS[op](df[col].to_numpy(), value)
+    return mask
+
+
+def _top_k_indices(sims: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first; O(N) selection plus a sort of k items."""
+    if k < len(sims):
+        part = np.argpartition(-sims, k)[:k]
+        return part[np.argsort(-sims[part])]
+    return np.argsort(-sims)
+
+
+# Listing fields passed to the LLM for each retrieved row
+CONTEXT_COLUMNS = ["id", "full_text", "neighborhood", "price", "bedrooms", "bathrooms"]
+
+
+def _contexts_from_frame(df, scores) -> List[Dict[str, Any]]:
+    """Build context dicts from a result frame with one to_dict call, then attach scores."""
+    records = df[CONTEXT_COLUMNS].to_dict(orient="records")
+    for rec, s in zip(records, scores):
+        rec["score"] = float(s) if s is not None else None
+        rec["bedrooms"] = int(rec["bedrooms"]) if rec["bedrooms"] is not None else None
+        rec["bathrooms"] = int(rec["bathrooms"]) if rec["bathrooms"] is not None else None
+    return records
 
 
 class RAGEngine:
-    def __init__(self, db_manager: RealEstateDBManager, embed_fn):
+    def __init__(self, db_manager: RealEstateDBManager, embed_fn, ef_search: int = EF_SEARCH):
         self.db = db_manager
         self.embed_fn = embed_fn
+        self.ef_search = ef_search
+        # repeated queries (dev/eval loops) reuse the embedding instead of another API call
+        self._embed_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self._embed_query_uncached)
+        # (table version, faiss.IndexFlatIP) over the fallback matrix, rebuilt when the table changes
+        self._faiss: Optional[Tuple[int, Any]] = None
+        # (table version, int8 rows, per-row scales) for the INT8_MIN_ROWS fallback path
+        self._int8: Optional[Tuple[int, np.ndarray, np.ndarray]] = None
+
+    def _embed_query_uncached(self, text: str) -> np.ndarray:
+        qv = np.array(self.embed_fn(text), dtype=np.float32)
+        qv.setflags(write=False)  # shared between cache hits
+        return qv
 
-    def query(self, user_query: str, k: int = 5) -> Dict[str, Any]:
-        qv = np.array(self.embed_fn(user_query), dtype=float)
+    def _faiss_index(self, emb_arr: np.ndarray):
+        """IndexFlatIP over the (already normalized) embedding matrix for the current table version."""
+        version = self.db.table.version
+        if self._faiss is None or self._faiss[0] != version:
+            index = faiss.IndexFlatIP(emb_arr.shape[1])
+            index.add(emb_arr)
+            self._faiss = (version, index)
+        return self._faiss[1]
+
+    def _int8_rows(self, emb_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """int8 rows and per-row scales of the embedding matrix, quantized once per table version."""
+        version = self.db.table.version
+        if self._int8 is None or self._int8[0] != version:
+            self._int8 = (version, *_quantize_int8(emb_arr))
+        return self._int8[1], self._int8[2]
+
+    def query(self, user_query: str, k: int = 5, filters: Optional[Dict[str, Any]] = None,
+              ef_search: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Retrieve the top-k listings for user_query and generate an answer.
+        filters: optional structured constraints applied before ranking, e.g.
+            {"min_bedrooms": 3, "max_price_usd": 1500000, "neighborhood": "Oak Hill"}
+        ef_search: HNSW beam width for this query (defaults to the engine's ef_search)
+        """
+        qv = self._embed_query(user_query)
+        triples = _parse_filters(filters)
 
         # 1) try native LanceDB search
         lres = None
         try:
-            lres = self.db.search_with_lancedb(qv.tolist(), limit=k)
+            lres = self.db.search_with_lancedb(qv.tolist(), limit=k, where=_where_clause(triples),
+                                               ef=ef_search or self.ef_search, refine_factor=REFINE_FACTOR,
+                                               columns=CONTEXT_COLUMNS)
         except Exception as e:
             lres = None
 
-        contexts = []
-        if lres is not None and not lres.empty:
-            # convert pandas rows into safe dicts
-            for _, row in lres.iterrows():
-                contexts.append({
-                    "id": str(row["id"]),
-                    "score": float(row.get("score", 0.0)) if "score" in row else None,
-                    "full_text": str(row["full_text"]),
-                    "neighborhood": str(row.get("neighborhood", "")),
-                    "price": str(row.get("price", "")),
-                    "bedrooms": int(row.get("bedrooms", 0)) if row.get("bedrooms", None) is not None else None,
-                    "bathrooms": int(row.get("bathrooms", 0)) if row.get("bathrooms", None) is not None else None,
-                })
+        if lres is not None and lres.empty:
+            # native search worked and nothing matched (e.g. filters too strict): no fallback
+            return {"query": user_query, "top_k": []}
+        if lres is not None:
+            if "score" in lres.columns:
+                scores = lres["score"].to_numpy()
+            elif "_distance" in lres.columns:
+                scores = 1.0 - lres["_distance"].to_numpy()  # cosine distance -> similarity
+            else:
+                scores = [None] * len(lres)
+            contexts = _contexts_from_frame(lres, scores)
             return self._generate_answer(user_query, qv, contexts)
 
-        # 2) fallback: load all embeddings, compute cosine similarities in-memory
+        # 2) native search failed; fallback for small tables only: load all embeddings,
+        #    compute cosine similarities in-memory
+        if self.db.table.count_rows() >= BRUTE_FORCE_MAX_ROWS:
+            raise RuntimeError("LanceDB native search failed; refusing a brute-force scan of a large table")
         ids, embeddings, df = self.db.fetch_all_embeddings()
         if len(embeddings) == 0:
             return {"query": user_query, "top_k": []}
 
-        emb_arr = np.array(embeddings, dtype=float)
-        sims = _cosine_similarity_matrix(emb_arr, qv)
-        top_idx = np.argsort(-sims)[:k]
-
-        for idx in top_idx:
-            row = df.iloc[idx]
-            contexts.append({
-                "id": str(row["id"]),
-                "score": float(sims[idx]),
-                "full_text": str(row["full_text"]),
-                "neighborhood": str(row.get("neighborhood", "")),
-                "price": str(row.get("price", "")),
-                "bedrooms": int(row.get("bedrooms", 0)) if row.get("bedrooms", None) is not None else None,
-                "bathrooms": int(row.get("bathrooms", 0)) if row.get("bathrooms", None) is not None else None,
-            })
+        # stored rows are already unit-length, so only the query needs normalizing
+        emb_arr = np.asarray(embeddings, dtype=np.float32)
+        q_norm = l2_normalize(qv)
+        if faiss is not None and not triples:
+            scores, top_idx = self._faiss_index(emb_arr).search(q_norm.reshape(1, -1), min(k, len(emb_arr)))
+            scores, top_idx = scores[0], top_idx[0]
+        else:
+            if INT8_MIN_ROWS and len(emb_arr) >= INT8_MIN_ROWS:
+                sims = _int8_similarities(*self._int8_rows(emb_arr), q_norm)
+            else:
+                sims = emb_arr @ q_norm
+            if triples:
+                sims = np.where(_filter_mask(df, triples), sims, -np.inf)
+            top_idx = _top_k_indices(sims, k)
+            top_idx = top_idx[np.isfinite(sims[top_idx])]
+            scores = sims[top_idx]
 
+        # only the k survivors need their text columns
+        detail_df = self.db.fetch_rows_by_ids([ids[i] for i in top_idx])
+        contexts = _contexts_from_frame(detail_df, scores)
         return self._generate_answer(user_query, qv, contexts)
 
     def _generate_answer(self, user_query: str, qv, contexts: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
         Build a prompt and call the LLM. If OpenAI is not configured, return the contexts
-        as a JSON-safe debug response.
+        as a debug response.
         """
-        # Always sanitize contexts
-        contexts = _to_json_safe(contexts)
-
         if not openai.api_key:
             return {"query": user_query, "top_k": contexts}
 
@@ -142,5 +305,4 @@ class RAGEngine:
         )
 
         answer_text = resp["choices"][0]["message"]["content"]
-        result = {"answer": answer_text, "retrieved": contexts}
-        return _to_json_safe(result)
+        return {"answer": answer_text, "retrieved": contexts}
@@ -3,47 +3,229 @@ RealEstateDBManager - LanceDB-backed ingestion and search utilities.
 
 Features:
 - create/open LanceDB table with a stable schema
-- deduplicated ingestion using content MD5 hashes
-- optional index creation (guarded for LanceDB versions)
+- deduplicated ingestion using content hashes (blake3, or MD5 via HASH=md5)
+- raw-listing -> id sidecar so unchanged listings skip text building and hashing
+- existing-id sidecar tied to the table version, so ingest skips the id scan
+- whole-file blake3 sentinel, so re-ingesting an unchanged listings file is a no-op
+- embeddings stored L2-normalized (cosine similarity == dot product) as float16
+- numeric price_usd column with a BTREE index, so price filters are pushed down
+- IVF_HNSW_SQ index (re)built after bulk ingest once the table is large enough,
+  optionally in a background thread (guarded for LanceDB versions)
 - native LanceDB search + in-memory cosine fallback
 - JSON-safe results returned to callers
 """
 
+import functools
+import glob
 import hashlib
-import json
+import math
+import multiprocessing as mp
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Optional, Any, Dict
 
+import blake3
+import ijson
 import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
 import lancedb
-from lancedb.pydantic import LanceModel
+from lancedb.pydantic import LanceModel, Vector
 
-DEFAULT_EMBED_DIM = int(__import__("os").getenv("EMBED_DIM", "1536"))
+import embedding_utils
+from embedding_utils import embedding_dim, estimate_tokens, l2_normalize_rows
 
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "128"))  # texts per embedding API call
+# estimated tokens per embedding API call (the OpenAI endpoint rejects requests above 300k)
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "10"))  # concurrent embedding calls during ingest
+# Listing id hash: "blake3" (default) or "md5" for tables ingested before the switch
+LISTING_HASH = os.getenv("HASH", "blake3")
+# Below this many rows a flat scan beats building and probing an ANN index
+INDEX_MIN_ROWS = int(os.getenv("INDEX_MIN_ROWS", "10000"))
+# HNSW graph parameters for 1536-d embeddings: more links and a wider build beam than
+# the defaults, for better recall at a modest build-time cost
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 400
+# Columns read by the full-table fallback scan; long text columns are fetched only for the top-k
+SCAN_COLUMNS = ["id", "neighborhood", "price", "price_usd", "bedrooms", "bathrooms", "embedding"]
+# Prices are parsed as an amount with an optional K/M/B suffix once "$", "," and spaces are
+# stripped ("$1,200,000", "$1.5M", "850k"); anything else (e.g. "call for price") is null
+_PRICE_RE = r"([0-9]+(?:\.[0-9]+)?)([KMB]?)"
+_PRICE_MULTIPLIERS = {"": 1.0, "K": 1e3, "M": 1e6, "B": 1e9}
+# The same parse in Lance SQL (no CASE support), to backfill price_usd in older tables:
+# amount * 1000 ** (position of the suffix in "KMB")
+_PRICE_SQL_TEXT = "regexp_replace(upper(price), '[\\s$,]', '', 'g')"
+_PRICE_SQL_RE = f"'^{_PRICE_RE}$|^.*$'"
+PRICE_USD_SQL = (
+    f"CAST(NULLIF(regexp_replace({_PRICE_SQL_TEXT}, {_PRICE_SQL_RE}, '${{1}}'), '') AS DOUBLE)"
+    f" * power(1000.0, strpos('_KMB', regexp_replace({_PRICE_SQL_TEXT}, {_PRICE_SQL_RE}, '${{2}}')) - 1)"
+)
 
+
+@functools.lru_cache(maxsize=4096)
 def compute_listing_id(full_text: str) -> str:
-    """Deterministic id for a listing based on its full_text."""
-    return hashlib.md5(full_text.encode("utf-8")).hexdigest()
+    """Deterministic id for a listing based on its full_text (32 hex chars)."""
+    if LISTING_HASH == "md5":
+        return hashlib.md5(full_text.encode("utf-8")).hexdigest()
+    return blake3.blake3(full_text.encode("utf-8")).hexdigest()[:32]
+
+
+# typed=True: 4 and 4.0 render differently ("Bedrooms: 4" vs "Bedrooms: 4.0")
+@functools.lru_cache(maxsize=4096, typed=True)
+def _make_full_text_cached(neighborhood, neighborhood_description, price, bedrooms,
+                           bathrooms, house_size, description) -> str:
+    """Body of RealEstateDBManager.make_full_text, memoized on the listing's field values."""
+    # one f-string instead of a list of parts + filter + join; "Area" is the only optional
+    # part. rstrip() matches the old strip(): the text always starts with "Neighborhood:".
+    area = f"Area: {neighborhood_description}. " if neighborhood_description else ""
+    return (
+        f"Neighborhood: {neighborhood}. {area}Price: {price}. "
+        f"Bedrooms: {bedrooms}, Bathrooms: {bathrooms}. Size: {house_size}. Details: {description}"
+    ).rstrip()
+
+
+def parse_price_usd(price) -> Optional[float]:
+    """"$1,200,000" -> 1200000.0, "$1.5M" -> 1500000.0; None when it is not a plain amount."""
+    if isinstance(price, (int, float)):
+        return float(price)
+    if not isinstance(price, str):
+        return None
+    m = re.fullmatch(_PRICE_RE, re.sub(r"[\s$,]", "", price.upper()))
+    if m is None:
+        return None
+    return float(m.group(1)) * _PRICE_MULTIPLIERS[m.group(2)]
+
+
+def compute_file_hash(path: str, block_size: int = 1 << 20) -> str:
+    """blake3 hex digest of a file's bytes, read in blocks."""
+    h = blake3.blake3()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def compute_raw_key(raw: dict) -> str:
+    """Cheap key for a raw listing dict: blake3 of its canonical (sorted-keys) JSON."""
+    return blake3.blake3(orjson.dumps(raw, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
 
 
 class RealEstateListing(LanceModel):
     id: str
     neighborhood: str
     price: str
+    price_usd: Optional[float]  # parsed from price; filter on this, not on the string
     bedrooms: float
     bathrooms: float
     house_size: str
     description: str
     neighborhood_description: str
     full_text: str
-    embedding: List[float]  # vector
+    # float16 halves storage and scan bandwidth; tables created with the float32 schema
+    # keep working, LanceDB casts the batch to the table's type on add. The width here is
+    # the default model's; tables are created with listing_schema() for the actual one.
+    embedding: Vector(1536, pa.float16())
+
+
+def listing_schema(dim: int) -> pa.Schema:
+    """RealEstateListing's Arrow schema with a dim-wide embedding vector."""
+    schema = RealEstateListing.to_arrow_schema()
+    i = schema.get_field_index("embedding")
+    return schema.set(i, schema.field(i).with_type(pa.list_(pa.float16(), dim)))
+
+
+def _iter_embed_batches(rows, max_tokens: int = EMBED_BATCH_TOKENS):
+    """Group (listing_id, raw, full_text) rows into batches of at most EMBED_BATCH texts
+    and max_tokens estimated tokens."""
+    pending, pending_tokens = [], 0
+    for row in rows:
+        n_tokens = estimate_tokens([row[2]])
+        if pending and pending_tokens + n_tokens > max_tokens:
+            yield pending
+            pending, pending_tokens = [], 0
+        pending.append(row)
+        pending_tokens += n_tokens
+        if len(pending) == EMBED_BATCH:
+            yield pending
+            pending, pending_tokens = [], 0
+    if pending:
+        yield pending
+
+
+def _embed_rows(rows, embed_many) -> np.ndarray:
+    """Embed the rows' full_text into an (N, D) float32 matrix of unit-length vectors."""
+    embs = embed_many([full_text for _, _, full_text in rows])
+    if len(embs) != len(rows):
+        raise ValueError("embed_many must return one embedding per text")
+    emb_matrix = np.array(embs, dtype=np.float32)
+    if emb_matrix.ndim != 2:
+        raise ValueError("embed_fn must return a list of floats")
+    # store unit-length vectors so cosine similarity is a plain dot product
+    l2_normalize_rows(emb_matrix)
+    return emb_matrix
+
+
+def _listing_batch(rows, emb: np.ndarray) -> pa.RecordBatch:
+    """
+    One RecordBatch for the rows, built from one Python list per column (no per-row
+    dicts). The embeddings go in as a single N x D float16 buffer instead of being
+    converted row by row (normalized in float32; readers upcast and re-normalize).
+    """
+    schema = listing_schema(emb.shape[1])
+    columns = {name: [] for name in schema.names if name != "embedding"}
+    for listing_id, raw, full_text in rows:
+        columns["id"].append(listing_id)
+        columns["neighborhood"].append(raw.get("neighborhood", ""))
+        columns["price"].append(raw.get("price", ""))
+        columns["price_usd"].append(parse_price_usd(raw.get("price", "")))
+        columns["bedrooms"].append(raw.get("bedrooms", 0))
+        columns["bathrooms"].append(raw.get("bathrooms", 0))
+        columns["house_size"].append(raw.get("house_size", ""))
+        columns["description"].append(raw.get("description", ""))
+        columns["neighborhood_description"].append(raw.get("neighborhood_description", ""))
+        columns["full_text"].append(full_text)
+    emb = emb.astype(np.float16)
+    arrays = [pa.array(columns[name], type=schema.field(name).type) for name in columns]
+    arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(emb.ravel(), type=pa.float16()), emb.shape[1]))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _init_shard_worker(tokens_per_min: int) -> None:
+    """Pool initializer: give this worker its share of the embedding token budget."""
+    embedding_utils.EMBED_TOKENS_PER_MIN = tokens_per_min
+
+
+def _ingest_shard(task) -> int:
+    """Worker for ingest_listings_sharded: embed one shard of new listings and append it."""
+    db_path, table_name, rows, embed_many = task
+    table = lancedb.connect(db_path).open_table(table_name)
+    # the rate limiter always admits the first batch of a window, so a batch larger than
+    # this worker's budget share would overshoot it every minute
+    max_tokens = min(EMBED_BATCH_TOKENS, embedding_utils.EMBED_TOKENS_PER_MIN)
+    emb = np.vstack([_embed_rows(chunk, embed_many) for chunk in _iter_embed_batches(rows, max_tokens)])
+    table.add(_listing_batch(rows, emb))
+    return len(rows)
 
 
 class RealEstateDBManager:
-    def __init__(self, db_path: str, table_name: str = "real_estate_listing"):
+    def __init__(self, db_path: str, table_name: str = "real_estate_listing",
+                 embed_dim: Optional[int] = None):
+        """
+        embed_dim: embedding width for newly created tables; defaults to the width of
+            embedding_utils.get_embedder()'s model. Pass it when ingesting with another embedder.
+        """
         self.db = lancedb.connect(db_path)
+        self.db_path = db_path
         self.table_name = table_name
+        self.embed_dim = embed_dim
         self.table = None
+        self.index_thread: Optional[threading.Thread] = None
+        # (table version, ids, normalized float32 embedding matrix, DataFrame) from the last full read
+        self._embed_cache: Optional[Tuple[int, List[str], np.ndarray, pd.DataFrame]] = None
 
     def create_table(self, force: bool = False) -> None:
         """
@@ -51,13 +233,17 @@ class RealEstateDBManager:
         """
         if force:
             self.db.drop_table(self.table_name, ignore_missing=True)
+            self._drop_ids_cache()
+            self._drop_ingest_sentinel()
             print(f"Dropped old table: {self.table_name}")
 
         if self.table_name not in self.db.table_names():
-            self.table = self.db.create_table(self.table_name, schema=RealEstateListing)
+            self.table = self.db.create_table(self.table_name, schema=listing_schema(self._embed_dim()))
             print(f"Created new LanceDB table: {self.table_name}")
         else:
             self.table = self.db.open_table(self.table_name)
+            self._check_legacy_table()
+            self._add_missing_columns()
             print(f"Opened existing LanceDB table: {self.table_name}")
 
     def get_or_create_table(self):
@@ -65,113 +251,427 @@ class RealEstateDBManager:
             return self.table
         if self.table_name in self.db.table_names():
             self.table = self.db.open_table(self.table_name)
+            self._check_legacy_table()
+            self._add_missing_columns()
             print(f"Loaded existing table: {self.table_name}")
         else:
-            self.table = self.db.create_table(self.table_name, schema=RealEstateListing)
+            self.table = self.db.create_table(self.table_name, schema=listing_schema(self._embed_dim()))
             print(f"Created new table: {self.table_name}")
         return self.table
 
+    def _embed_dim(self) -> int:
+        return self.embed_dim or embedding_dim()
+
+    def _check_legacy_table(self) -> None:
+        """
+        Refuse tables this code cannot extend safely: a list<double> embedding column
+        (no native vector search) or listing ids computed with a different hash than
+        HASH, which would make every listing look new and be appended a second time.
+        """
+        emb_type = self.table.schema.field("embedding").type
+        if not pa.types.is_fixed_size_list(emb_type):
+            raise RuntimeError(
+                f"Table {self.table_name!r} stores embeddings as {emb_type}, not a fixed-size "
+                "vector, so native search cannot run on it. Re-create it with "
+                "create_table(force=True) (run_pipeline.py --force).")
+        sample = self.table.search().select(["id", "full_text"]).limit(5).to_arrow().to_pylist()
+        if sample and not any(compute_listing_id(r["full_text"]) == r["id"] for r in sample):
+            raise RuntimeError(
+                f"Listing ids in table {self.table_name!r} were not computed with HASH={LISTING_HASH}; "
+                "re-ingesting would duplicate every listing. Set HASH to the hash the table was "
+                "built with (HASH=md5 for tables from before the blake3 switch), or re-create it "
+                "with create_table(force=True) (run_pipeline.py --force).")
+
+    def _add_missing_columns(self) -> None:
+        """Backfill price_usd from the price strings in tables created before it existed."""
+        if "price_usd" not in self.table.schema.names:
+            self.table.add_columns({"price_usd": PRICE_USD_SQL})
+            print("Added price_usd column to existing table")
+
+    def _ids_cache_path(self, version: int) -> str:
+        return os.path.join(self.db_path, f"ids_{self.table_name}.v{version}.parquet")
+
+    def _drop_ids_cache(self) -> None:
+        for path in glob.glob(os.path.join(self.db_path, f"ids_{self.table_name}.v*.parquet")):
+            os.remove(path)
+
+    def load_existing_ids(self) -> set:
+        """
+        Ids currently in the table. Read from the id sidecar when it was written for the
+        current table version, otherwise from a projected scan of the id column.
+        """
+        try:
+            return set(pd.read_parquet(self._ids_cache_path(self.table.version))["id"])
+        except Exception:
+            pass
+        try:
+            return set(self.table.search().select(["id"]).limit(None).to_arrow()["id"].to_pylist())
+        except Exception:
+            return set()
+
+    def save_existing_ids(self, ids: set) -> None:
+        """Write the id sidecar for the current table version, replacing older ones."""
+        self._drop_ids_cache()
+        pd.DataFrame({"id": list(ids)}).to_parquet(self._ids_cache_path(self.table.version))
+
+    def _sentinel_path(self) -> str:
+        return os.path.join(self.db_path, f"ingest_{self.table_name}.sentinel")
+
+    def _read_ingest_sentinel(self) -> Optional[dict]:
+        try:
+            with open(self._sentinel_path(), "rb") as f:
+                return orjson.loads(f.read())
+        except Exception:
+            return None
+
+    def _write_ingest_sentinel(self, file_hash: str) -> None:
+        """Record that the table at its current version holds everything in the file with file_hash."""
+        with open(self._sentinel_path(), "wb") as f:
+            f.write(orjson.dumps({"file_hash": file_hash, "version": self.table.version}))
+
+    def _drop_ingest_sentinel(self) -> None:
+        if os.path.exists(self._sentinel_path()):
+            os.remove(self._sentinel_path())
+
     def make_full_text(self, raw: dict) -> str:
-        parts = [
-            f"Neighborhood: {raw.get('neighborhood','')}",
-            (f"Area: {raw.get('neighborhood_description','')}") if raw.get('neighborhood_description') else "",
-            f"Price: {raw.get('price','')}",
-            f"Bedrooms: {raw.get('bedrooms','')}, Bathrooms: {raw.get('bathrooms','')}",
-            f"Size: {raw.get('house_size','')}",
-            f"Details: {raw.get('description','')}"
-        ]
-        return ". ".join([p for p in parts if p]).strip()
-
-    def ingest_listings(self, json_path: str, embed_fn):
+        fields = (
+            raw.get('neighborhood', ''),
+            raw.get('neighborhood_description', ''),
+            raw.get('price', ''),
+            raw.get('bedrooms', ''),
+            raw.get('bathrooms', ''),
+            raw.get('house_size', ''),
+            raw.get('description', ''),
+        )
+        try:
+            return _make_full_text_cached(*fields)
+        except TypeError:
+            # a list/dict field value (valid JSON) cannot be a cache key: format it uncached
+            return _make_full_text_cached.__wrapped__(*fields)
+
+    def ingest_listings(self, json_path: str, embed_fn, embed_many=None,
+                        build_index: bool = True, background_index: bool = False):
         """
         Ingest listings from JSON while avoiding duplicates.
 
         json_path: path to a JSON file having structure { "listings": [ ... ] }
-        embed_fn: callable(text: str) -> List[float]
+        embed_fn: callable(text: str) -> float32 vector (np.ndarray or list of floats)
+        embed_many: optional callable(texts: List[str]) -> list of vectors; when given,
+            new listings are embedded in batches of at most EMBED_BATCH texts and
+            EMBED_BATCH_TOKENS estimated tokens, up to EMBED_WORKERS
+            batches in flight at once, instead of one call each. Must be thread-safe.
+        build_index: set False to skip (re)building the indexes after ingest; when nothing
+            new is added, only a missing vector index is built (see build_indices)
+        background_index: build the vector index in a thread (see build_index_in_background)
+            so queries can be served by a flat scan meanwhile
+
+        The index is built after all rows are added, and only for tables of at least
+        INDEX_MIN_ROWS rows; smaller tables are searched with a flat scan.
+
+        If the file is byte-identical to the last one fully ingested into this table, and
+        the table has not been written since, nothing is parsed or hashed per listing.
         """
         table = self.get_or_create_table()
+        file_hash = compute_file_hash(json_path)
+        if self._read_ingest_sentinel() == {"file_hash": file_hash, "version": table.version}:
+            print("Listings file unchanged since the last ingest; nothing to do.")
+            if build_index:
+                self.build_indices(background_index, missing_only=True)
+            return
+        if embed_many is None:
+            embed_many = lambda texts: [embed_fn(t) for t in texts]
+
+        # Load existing IDs (sidecar if current, else a projected scan of the id column)
+        existing_ids = self.load_existing_ids()
+        seen_ids, n_seen = self._load_seen_ids()
+
+        # 1) stream new listings from the file; each full batch is handed to the embedding
+        #    threads while parsing continues, so parsing overlaps the network-bound calls
+        chunks, futures = [], []
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool, open(json_path, "rb") as f:
+            for chunk in _iter_embed_batches(self._iter_new_listings(f, existing_ids, seen_ids)):
+                chunks.append(chunk)
+                futures.append(pool.submit(_embed_rows, chunk, embed_many))
+        self._save_seen_ids(seen_ids, n_seen)
+
+        if not chunks:
+            print("No new listings to add.")
+            self._write_ingest_sentinel(file_hash)
+            if build_index:
+                self.build_indices(background_index, missing_only=True)
+            return
+
+        # 2) zip the vectors back onto their listings in order and add them as one RecordBatch
+        rows = [row for chunk in chunks for row in chunk]
+        table.add(_listing_batch(rows, np.vstack([future.result() for future in futures])))
+        print(f"Added {len(rows)} new listings")
+        self._finish_ingest(existing_ids, file_hash, build_index, background_index)
+
+    def ingest_listings_sharded(self, json_path: str, embed_many, shards: Optional[int] = None,
+                                build_index: bool = True, background_index: bool = False):
+        """
+        ingest_listings() with the embedding and table writes spread over `shards` worker
+        processes (default min(cpu_count, 8)). The file is parsed and deduplicated here;
+        each worker embeds its share of the new listings and appends them to the table.
+
+        embed_many: callable(texts: List[str]) -> list of vectors; must be picklable
+            (e.g. embedding_utils.get_batch_embedder()), each worker gets its own copy.
+            Each worker is limited to EMBED_TOKENS_PER_MIN // shards tokens per minute,
+            and its batches to that many tokens, so together they stay within the budget.
 
-        # Load existing IDs (fast path)
+        Workers are started with "spawn": LanceDB is multithreaded and not fork-safe, so
+        the calling script needs an `if __name__ == "__main__":` guard.
+        """
+        table = self.get_or_create_table()
+        file_hash = compute_file_hash(json_path)
+        if self._read_ingest_sentinel() == {"file_hash": file_hash, "version": table.version}:
+            print("Listings file unchanged since the last ingest; nothing to do.")
+            if build_index:
+                self.build_indices(background_index, missing_only=True)
+            return
+        shards = shards or min(os.cpu_count() or 1, 8)
+
+        existing_ids = self.load_existing_ids()
+        seen_ids, n_seen = self._load_seen_ids()
+        with open(json_path, "rb") as f:
+            rows = list(self._iter_new_listings(f, existing_ids, seen_ids))
+        self._save_seen_ids(seen_ids, n_seen)
+
+        if not rows:
+            print("No new listings to add.")
+            self._write_ingest_sentinel(file_hash)
+            if build_index:
+                self.build_indices(background_index, missing_only=True)
+            return
+
+        # contiguous shards; duplicates were already dropped, so shards never overlap
+        size = -(-len(rows) // shards)
+        tasks = [(self.db_path, self.table_name, rows[i:i + size], embed_many)
+                 for i in range(0, len(rows), size)]
+        # the token budget is enforced per process, so split it between the workers
+        tokens_per_min = max(1, embedding_utils.EMBED_TOKENS_PER_MIN // len(tasks))
+        with mp.get_context("spawn").Pool(len(tasks), initializer=_init_shard_worker,
+                                          initargs=(tokens_per_min,)) as pool:
+            n_added = sum(pool.imap_unordered(_ingest_shard, tasks))
+        print(f"Added {n_added} new listings from {len(tasks)} shards")
+
+        self.table = self.db.open_table(self.table_name)  # pick up the workers' commits
+        self._finish_ingest(existing_ids, file_hash, build_index, background_index)
+
+    def _load_seen_ids(self) -> Tuple[Dict[str, str], int]:
+        """raw_key -> listing_id from earlier runs; ids depend on the hash, so one file per hash."""
         try:
-            existing_df = table.to_pandas()
-            existing_ids = set(existing_df["id"].tolist()) if not existing_df.empty else set()
+            seen_df = pd.read_parquet(self._seen_ids_path())
+            seen_ids = dict(zip(seen_df["raw_key"], seen_df["listing_id"]))
         except Exception:
-            existing_ids = set()
+            seen_ids = {}
+        return seen_ids, len(seen_ids)
+
+    def _save_seen_ids(self, seen_ids: Dict[str, str], n_seen: int) -> None:
+        if len(seen_ids) > n_seen:
+            pd.DataFrame({"raw_key": list(seen_ids),
+                          "listing_id": list(seen_ids.values())}).to_parquet(self._seen_ids_path())
 
-        with open(json_path, "r") as f:
-            data = json.load(f)
+    def _seen_ids_path(self) -> str:
+        return os.path.join(self.db_path, f"ids_seen_{LISTING_HASH}.parquet")
+
+    def _iter_new_listings(self, f, existing_ids: set, seen_ids: Dict[str, str]):
+        """
+        Stream (listing_id, raw, full_text) for listings in f not yet in existing_ids,
+        skipping duplicates within the file too. Adds the yielded ids to existing_ids and
+        new raw_key -> id pairs to seen_ids.
+        """
+        for raw in ijson.items(f, "listings.item", use_float=True):
+            raw_key = compute_raw_key(raw)
+            listing_id = seen_ids.get(raw_key)
+            if listing_id is not None and listing_id in existing_ids:
+                continue
 
-        docs = []
-        for raw in data.get("listings", []):
             full_text = self.make_full_text(raw)
-            listing_id = compute_listing_id(full_text)
+            if listing_id is None:
+                listing_id = compute_listing_id(full_text)
+                seen_ids[raw_key] = listing_id
 
             if listing_id in existing_ids:
                 continue
+            existing_ids.add(listing_id)
+            yield listing_id, raw, full_text
+
+    def _finish_ingest(self, existing_ids: set, file_hash: str, build_index: bool,
+                       background_index: bool) -> None:
+        """Record the ingest in the id sidecar and sentinel, then (re)build the index if due."""
+        # existing_ids now holds every id in the table, including the ones just added
+        self.save_existing_ids(existing_ids)
+        self._write_ingest_sentinel(file_hash)
+        if build_index:
+            self.build_indices(background_index)
+
+    def has_vector_index(self) -> bool:
+        """True if the embedding column is indexed, or an index build is running in this process."""
+        if self.index_thread is not None and self.index_thread.is_alive():
+            return True
+        try:
+            return any("embedding" in idx.columns for idx in self.table.list_indices())
+        except Exception:
+            return False
 
-            emb = embed_fn(full_text)
-            if not isinstance(emb, (list, tuple)):
-                raise ValueError("embed_fn must return a list of floats")
-
-            docs.append({
-                "id": listing_id,
-                "neighborhood": raw.get("neighborhood", ""),
-                "price": raw.get("price", ""),
-                "bedrooms": raw.get("bedrooms", 0),
-                "bathrooms": raw.get("bathrooms", 0),
-                "house_size": raw.get("house_size", ""),
-                "description": raw.get("description", ""),
-                "neighborhood_description": raw.get("neighborhood_description", ""),
-                "full_text": full_text,
-                "embedding": emb,
-            })
-
-        if docs:
-            table.add(docs)
-            print(f"Added {len(docs)} new listings")
+    def build_indices(self, background_index: bool = False, missing_only: bool = False) -> None:
+        """
+        (Re)build the price_usd and vector indexes once the table has INDEX_MIN_ROWS rows.
+        missing_only: only build when there is no vector index yet, e.g. after an ingest
+            that added nothing to a table last ingested with build_index=False
+        """
+        n = self.table.count_rows()
+        if n < INDEX_MIN_ROWS or (missing_only and self.has_vector_index()):
+            return
+        index_kwargs = dict(
+            index_type="IVF_HNSW_SQ",
+            metric="cosine",
+            num_partitions=max(1, int(math.sqrt(n))),
+            m=HNSW_M,
+            ef_construction=HNSW_EF_CONSTRUCTION,
+            replace=True,
+        )
+        self.create_price_index()
+        if background_index:
+            self.build_index_in_background(**index_kwargs)
         else:
-            print("No new listings to add.")
+            self.create_vector_index(**index_kwargs)
+
+    def build_index_in_background(self, **kwargs) -> threading.Thread:
+        """
+        Run create_vector_index(**kwargs) in a separate thread and return it (also kept
+        as self.index_thread). Searches keep working on the previous index or a flat scan
+        until the new index is committed. The thread is non-daemon, so a script exits
+        only after the build has finished.
+        """
+        self.index_thread = threading.Thread(target=self.create_vector_index, kwargs=kwargs,
+                                             name="lancedb-index-build")
+        self.index_thread.start()
+        return self.index_thread
 
-    def create_vector_index(self, index_type: str = "hnsw", metric: str = "cosine", **kwargs):
+    def create_vector_index(self, index_type: str = "IVF_HNSW_SQ", metric: str = "cosine", **kwargs):
         """
         Optional: create an index on the embedding column.
         Not all LanceDB versions expose the same API; this is defensive.
         """
+        version = self.table.version
         try:
             # Some LanceDB versions accept different signatures; call guarded.
-            self.table.create_index("embedding", index_type=index_type, metric=metric, **kwargs)
+            self.table.create_index(metric=metric, vector_column_name="embedding", index_type=index_type, **kwargs)
             print("Created vector index on embedding")
         except TypeError as e:
             # fallback: some versions expect different argnames
             try:
-                self.table.create_index("embedding", index_type=index_type, **kwargs)
+                self.table.create_index(metric=metric, vector_column_name="embedding", **kwargs)
                 print("Created vector index (fallback signature)")
             except Exception as e2:
                 print("Could not create index:", e2)
         except Exception as e:
             print("Could not create index (maybe your LanceDB version lacks this API).", e)
+        self._carry_over_sidecars(version)
 
-    def search_with_lancedb(self, query_vec: List[float], limit: int = 5) -> Optional[pd.DataFrame]:
+    def create_price_index(self):
+        """
+        BTREE scalar index on price_usd, so min_/max_price_usd filters are resolved from
+        the index before the vector search instead of by scanning the column.
+        """
+        version = self.table.version
+        try:
+            self.table.create_scalar_index("price_usd", index_type="BTREE", replace=True)
+            print("Created scalar index on price_usd")
+        except Exception as e:
+            print("Could not create scalar index on price_usd:", e)
+        self._carry_over_sidecars(version)
+
+    def _carry_over_sidecars(self, version: int) -> None:
+        """An index build commits one version without touching rows: move the sidecars to it."""
+        if self.table.version != version + 1:
+            return
+        cached = self._ids_cache_path(version)
+        if os.path.exists(cached):
+            os.replace(cached, self._ids_cache_path(version + 1))
+        sentinel = self._read_ingest_sentinel()
+        if sentinel is not None and sentinel["version"] == version:
+            self._write_ingest_sentinel(sentinel["file_hash"])
+
+    def search_with_lancedb(self, query_vec: List[float], limit: int = 5,
+                            where: Optional[str] = None, ef: Optional[int] = None,
+                            refine_factor: Optional[int] = None,
+                            columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
         """
         Try to use native LanceDB search. Returns a pandas.DataFrame or None.
+        where: optional SQL predicate (e.g. "bedrooms >= 3") applied before the vector search.
+        ef: HNSW search beam width; higher trades latency for recall (ignored without HNSW).
+        refine_factor: fetch limit * refine_factor candidates from the quantized index and
+            re-rank them on the stored unquantized vectors (also makes _distance exact).
+        columns: optional projection; pass the columns you need so the embedding blob is
+            not returned with every hit. _distance is added to it, since LanceDB's
+            implicit projection of it is deprecated
         """
         try:
             # ensure query_vec is plain python list or numpy array
-            res = self.table.search(query_vec).limit(limit).to_pandas()
+            builder = self.table.search(query_vec)
+            # score with cosine distance (matches the index metric) instead of the L2 default
+            builder = builder.distance_type("cosine") if hasattr(builder, "distance_type") else builder.metric("cosine")
+            if where:
+                builder = builder.where(where, prefilter=True)
+            if ef is not None and hasattr(builder, "ef"):
+                builder = builder.ef(ef)
+            if refine_factor and hasattr(builder, "refine_factor"):
+                builder = builder.refine_factor(refine_factor)
+            if columns:
+                builder = builder.select(list(columns) + ["_distance"])
+            res = builder.limit(limit).to_pandas()
             return res
         except Exception as e:
             print("LanceDB.native search not available or failed:", e)
             return None
 
-    def fetch_all_embeddings(self) -> Tuple[List[str], List[List[float]], pd.DataFrame]:
+    def fetch_all_embeddings(self) -> Tuple[List[str], np.ndarray, pd.DataFrame]:
         """
-        Fallback: return list of ids, embeddings and full DataFrame for in-memory similarity.
+        Fallback: return list of ids, an (N, D) float32 matrix of L2-normalized embeddings
+        and a DataFrame of the other SCAN_COLUMNS for in-memory similarity and filtering.
+        Use fetch_rows_by_ids() for the remaining columns of the selected rows.
+
+        The result is cached until the table version changes, so repeated queries do not
+        re-read the table. Treat the returned objects as read-only.
         """
-        df = self.table.to_pandas()
+        version = self.table.version
+        if self._embed_cache is not None and self._embed_cache[0] == version:
+            return self._embed_cache[1:]
+
+        arrow = self.table.search().select(SCAN_COLUMNS).limit(None).to_arrow()
+        # the list column's child values are one flat N * D buffer: reshape it instead of
+        # stacking N per-row arrays
+        emb_col = arrow["embedding"].combine_chunks()
+        if pa.types.is_fixed_size_list(emb_col.type):
+            dim = emb_col.type.list_size
+        elif len(emb_col):
+            # tables from the original List[float] schema store list<double>
+            lengths = emb_col.value_lengths().to_numpy(zero_copy_only=False)
+            if lengths.min() != lengths.max():
+                raise ValueError("embedding column holds vectors of different lengths")
+            dim = int(lengths[0])
+        else:
+            dim = self._embed_dim()
+        embeddings = emb_col.flatten().to_numpy(zero_copy_only=False).reshape(-1, dim).astype(np.float32)
+        df = arrow.drop_columns(["embedding"]).to_pandas()
         ids = df["id"].tolist()
-        embeddings = df["embedding"].tolist()
+        l2_normalize_rows(embeddings)
+        embeddings.setflags(write=False)
+        self._embed_cache = (version, ids, embeddings, df)
         return ids, embeddings, df
 
+    def fetch_rows_by_ids(self, ids: List[str]) -> pd.DataFrame:
+        """Full rows (without the embedding) for the given ids, in the order given."""
+        columns = [c for c in RealEstateListing.field_names() if c != "embedding"]
+        if not ids:
+            return pd.DataFrame(columns=columns)
+        id_list = ", ".join("'" + str(i).replace("'", "''") + "'" for i in ids)
+        df = self.table.search().where(f"id IN ({id_list})").select(columns).limit(None).to_pandas()
+        return df.set_index("id").loc[list(ids)].reset_index()
+
     # Utility to produce JSON-safe dict rows
     @staticmethod
     def sanitize_row_for_json(row: dict) -> dict:
@@ -5,37 +5,64 @@ Before running:
 - Ensure OPENAI_API_KEY is set in the environment or OPENAI_KEY_FILE path exists.
 - Ensure LANCE DB path points to a writeable directory.
 - Listings file used in this demo: /mnt/data/listings.json
+
+Usage:
+    python run_pipeline.py [--force] [--skip-index] [--shards N] [--query "..."]
+
+Without --force the existing table is kept and only new listings are embedded,
+so a re-run on an unchanged listings file does no embedding work. Tables built by
+older versions (MD5 ids or unsized embedding lists) are refused with a message
+instead: re-run with HASH=md5 or --force.
 """
 
+import argparse
 import os
 from real_estate_db import RealEstateDBManager
-from embedding_utils import get_embedder
-from rag_pipeline import RAGEngine
+from embedding_utils import get_embedder, get_batch_embedder, CachedEmbedder
+from rag_pipeline import RAGEngine, dumps_json
 
 DB_PATH = os.getenv("LANCEDB_PATH", "../../../../data/GenAI/05_project/lancedb_store")
 JSON_PATH = os.getenv("LISTINGS_JSON", "listings.json")  # Listings file
+DEFAULT_QUERY = "Looking for a modern 3-bedroom with good schools, near public transit, under $1.5M"
+
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest listings into LanceDB and run a RAG query.")
+    parser.add_argument("--force", action="store_true",
+                        help="drop and recreate the table before ingesting")
+    parser.add_argument("--skip-index", action="store_true",
+                        help="do not (re)build the vector index after ingesting")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="embed and write new listings in N worker processes (0 = in-process threads)")
+    parser.add_argument("--query", default=DEFAULT_QUERY, help="query to run after ingestion")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     manager = RealEstateDBManager(DB_PATH)
-    # create_table(force=True) will drop old table.
-    manager.create_table(force=True)
+    # create_table(force=True) will drop old table; by default the existing one is reused.
+    manager.create_table(force=args.force)
 
     embed_fn = get_embedder()
 
-    # Ingest (deduplicated)
-    manager.ingest_listings(JSON_PATH, embed_fn)
-
-    # Try to create index (best-effort)
-    manager.create_vector_index(index_type="hnsw", metric="cosine")
+    # Order matters: create the table, bulk-ingest (deduplicated, batched embedding calls
+    # served from the on-disk cache), then index. The index is only built once the table
+    # has INDEX_MIN_ROWS rows, and in the background so the query below can run meanwhile.
+    if args.shards:
+        # worker processes need a picklable embedder, so the on-disk cache is not used here
+        manager.ingest_listings_sharded(JSON_PATH, get_batch_embedder(), shards=args.shards,
+                                        build_index=not args.skip_index, background_index=True)
+    else:
+        manager.ingest_listings(JSON_PATH, embed_fn, embed_many=CachedEmbedder(),
+                                build_index=not args.skip_index, background_index=True)
 
     # Run a sample RAG query
     rag = RAGEngine(manager, embed_fn)
-    user_query = "Looking for a modern 3-bedroom with good schools, near public transit, under $1.5M"
-    result = rag.query(user_query, k=5)
+    result = rag.query(args.query, k=5)
 
-    # Print JSON-safe output
-    import json
-    print(json.dumps(result, indent=2))
+    # Print JSON output
+    print(dumps_json(result, indent=True).decode())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file